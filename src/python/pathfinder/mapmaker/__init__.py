@@ -1,20 +1,29 @@
+import hashlib
 import io
 import logging
 import math
 import re
-import tempfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from enum import Enum
 from os.path import dirname, basename, abspath
 from pathlib import Path
 from typing import Literal
 
+import numpy as np
 import pypdf as pdf
-from PIL import Image, ImageEnhance
+from PIL import Image
 from pypdf.generic import IndirectObject
 from fpdf import FPDF
 from guizero import App, Picture
 
+try:
+    # Optional, used to run image enhancement as a single compiled pass if available
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
 
 class ImageGrid:
     """
@@ -105,6 +114,10 @@ class ImageGrid:
         app.display()
 
 
+# Matches filenames in the form foo_bar_12.4x25.3.png and extracts the name, 12.4, and 25.3 bits
+_FILENAME_PATTERN = re.compile(r'([\w-]+?)_*(\d+(?:\.\d*)?|\.\d+)x(\d+(?:\.\d*)?|\.\d+)\.png')
+
+
 def parse_filename(filename):
     """
     Parse a filename of the form name_WWxHH.png, i.e. deep_canyon_10x18.png, into a set of useful properties. Returns
@@ -120,9 +133,7 @@ def parse_filename(filename):
     """
     filename = abspath(filename)
     leaf_name = basename(filename)
-    # Match in the form foo_bar_12.4x25.3.png and extract the name, 12.4, and 25.3 bits
-    m = re.match(r'(^[\w-]+?)_*(\d+(?:\.\d*)?|\.\d+)x(\d+(?:\.\d*)?|\.\d+)\.png$',
-                 leaf_name)
+    m = _FILENAME_PATTERN.fullmatch(leaf_name)
     if m:
         name = m.groups()[0]
         width = float(m.groups()[1])
@@ -172,9 +183,121 @@ class Paper(Enum):
         return self.value.name
 
 
+def _pixel_mode(image):
+    """
+    Convert an image to one of L, RGB or RGBA if it isn't already, only using RGBA if the image has transparency
+
+    :param image:
+        Image to convert
+    :return:
+        The original image, or a converted copy
+    """
+    if image.mode in ('L', 'RGB', 'RGBA'):
+        return image
+    return image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+
+
+# Weights used by PIL when converting RGB to L, used as the degenerate image for saturation changes
+_LUMA = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+
+def _smooth(arr):
+    """
+    Apply PIL's 3x3 SMOOTH kernel to an HxWxC float array, leaving the outermost pixels untouched. This is the
+    degenerate image used by ImageEnhance.Sharpness, reproduced here so sharpening can be done in NumPy.
+
+    :param arr:
+        Float array of pixel data
+    :return:
+        A new, smoothed, array
+    """
+    out = arr.copy()
+    core = out[1:-1, 1:-1]
+    core *= 5
+    for dy in range(3):
+        for dx in range(3):
+            if dy != 1 or dx != 1:
+                core += arr[dy:arr.shape[0] - 2 + dy, dx:arr.shape[1] - 2 + dx]
+    core /= 13
+    return out
+
+
+def _enhance_numpy(src, brighten, sharpen, saturation):
+    """
+    Apply brighten, sharpen and saturation to an HxWxC uint8 array using whole array NumPy operations, where C is 3
+    for colour or 1 for greyscale. Any of the factors can be None to skip that operation, and saturation has no effect
+    on greyscale.
+
+    :return:
+        A new uint8 array
+    """
+    arr = src.astype(np.float32)
+    # Clip and truncate to whole levels after each operation, as PIL does when it produces an intermediate image
+    if brighten is not None:
+        arr *= brighten
+        np.clip(arr, 0, 255, out=arr)
+        np.trunc(arr, out=arr)
+    if sharpen is not None:
+        degenerate = _smooth(arr)
+        arr -= degenerate
+        arr *= sharpen
+        arr += degenerate
+        np.clip(arr, 0, 255, out=arr)
+        np.trunc(arr, out=arr)
+    if saturation is not None and arr.shape[2] == 3:
+        luma = (arr @ _LUMA)[..., None]
+        arr -= luma
+        arr *= saturation
+        arr += luma
+    np.clip(arr, 0, 255, out=arr)
+    arr += 0.5
+    return arr.astype(np.uint8)
+
+
+if njit is not None:
+    @njit(fastmath=True, cache=True)
+    def _level(v):
+        """
+        Clip to 0-255 and truncate to a whole level, as PIL does when storing an intermediate image
+        """
+        return float(int(min(255.0, max(0.0, v))))
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _enhance_kernel(src, out, brighten, sharpen, saturation):
+        """
+        Compiled equivalent of _enhance_numpy, walking the image once with rows processed in parallel and writing the
+        result into out. Factors of 1.0 have no effect.
+        """
+        height, width, channels = src.shape
+        for y in prange(height):
+            pixel = np.empty(channels, dtype=np.float32)
+            for x in range(width):
+                # Sharpening leaves the outermost pixels alone, as PIL's SMOOTH filter does
+                interior = sharpen != 1.0 and 0 < y < height - 1 and 0 < x < width - 1
+                for c in range(channels):
+                    v = _level(src[y, x, c] * brighten)
+                    if interior:
+                        # Blur the brightened, clipped, neighbours
+                        blur = 4.0 * v
+                        for dy in range(-1, 2):
+                            for dx in range(-1, 2):
+                                blur += _level(src[y + dy, x + dx, c] * brighten)
+                        blur /= 13.0
+                        v = _level(blur + sharpen * (v - blur))
+                    pixel[c] = v
+                # Greyscale pixels are their own luma, so saturation leaves them unchanged
+                luma = 0.299 * pixel[0] + 0.587 * pixel[1] + 0.114 * pixel[2] if channels == 3 else pixel[0]
+                for c in range(channels):
+                    v = luma + saturation * (pixel[c] - luma)
+                    out[y, x, c] = np.uint8(min(255.0, max(0.0, v)) + 0.5)
+
+
 def basic_image_ops(image, brighten=1.0, sharpen=None, saturation=None):
     """
-    Perform basic brighten, sharpen, colour operations on an image
+    Perform basic brighten, sharpen, colour operations on an image. All requested operations are applied in a single
+    pass over the pixel data, compiled with numba if it's installed, or as NumPy array operations if not. Any alpha
+    channel is passed through unchanged. Greyscale (L) images stay greyscale, images in any other mode are returned as
+    RGB, or RGBA if they have transparency.
 
     :param image:
         Image to process
@@ -187,20 +310,70 @@ def basic_image_ops(image, brighten=1.0, sharpen=None, saturation=None):
     :return:
         The modified image
     """
-    if brighten is not None and brighten != 1.0:
+    if brighten == 1.0:
+        brighten = None
+    if brighten is None and sharpen is None and saturation is None:
+        return image
+    if brighten is not None:
         logging.info('Applying brighten {}'.format(brighten))
-        image = ImageEnhance.Brightness(image).enhance(brighten)
     if sharpen is not None:
         logging.info('Applying sharpen {}'.format(sharpen))
-        image = ImageEnhance.Sharpness(image).enhance(sharpen)
     if saturation is not None:
         logging.info('Applying saturation {}'.format(saturation))
-        image = ImageEnhance.Color(image).enhance(saturation)
+    image = _pixel_mode(image)
+    alpha = image.getchannel('A') if image.mode == 'RGBA' else None
+    src = np.asarray(image.convert('RGB') if alpha is not None else image)
+    # Work on HxWxC arrays throughout, with a single channel for greyscale
+    grey = src.ndim == 2
+    if grey:
+        src = src[..., None]
+    if njit is not None:
+        arr = np.empty_like(src)
+        _enhance_kernel(src, arr,
+                        1.0 if brighten is None else brighten,
+                        1.0 if sharpen is None else sharpen,
+                        1.0 if saturation is None else saturation)
+    else:
+        arr = _enhance_numpy(src, brighten, sharpen, saturation)
+    image = Image.fromarray(arr[..., 0] if grey else arr)
+    if alpha is not None:
+        image.putalpha(alpha)
     return image
 
 
+def limit_resolution(im: Image, squares_wide: float, squares_high: float, print_dpi=None):
+    """
+    Scale down an image with far more resolution than can be printed, so enhancement and PDF encoding don't have to
+    process pixels that will never be seen. Images at up to 1.5 times the target resolution are returned unchanged, as
+    are all images if no target resolution is given.
+
+    :param im:
+        An Image to check
+    :param squares_wide:
+        The number of 1 inch squares along the width of the image
+    :param squares_high:
+        The number of 1 inch squares along the height of the image
+    :param print_dpi:
+        Target resolution in pixels per inch, or None to never scale
+    :return:
+        The original Image, or a scaled down copy
+    """
+    if print_dpi is None:
+        return im
+    # Same as the pixels per mm calculation used when splitting, but per inch
+    pixels_per_inch = min(im.width / squares_wide, im.height / squares_high)
+    if pixels_per_inch <= 1.5 * print_dpi:
+        return im
+    scale = print_dpi / pixels_per_inch
+    target_size = (round(im.width * scale), round(im.height * scale))
+    logging.info(f'limit_resolution: Scaling {im.width} x {im.height} pixels down to {target_size[0]} x '
+                 f'{target_size[1]} for {print_dpi} DPI')
+    return im.resize(target_size, resample=Image.Resampling.LANCZOS)
+
+
 def process_image_with_border(im: Image, squares_wide: float, squares_high: float, border_north=5, border_east=5,
-                              border_west=5, border_south=5, brighten=None, sharpen=None, saturation=None):
+                              border_west=5, border_south=5, brighten=None, sharpen=None, saturation=None,
+                              print_dpi=None):
     """
     Process an image and calculate sizes, but do not split. This is used when we want to obtain a PDF of a single page
     sized exactly to the image rather than splitting an image across multiple known sized pages. Some print houses can
@@ -227,10 +400,14 @@ def process_image_with_border(im: Image, squares_wide: float, squares_high: floa
         Set to >1.0 to shapen the image before splitting.
     :param saturation:
         Set to >1.0 to enhance colour, <1.0 to remove it, None for no effect
+    :param print_dpi:
+        Resolution the output will be printed at. Images with more than 1.5 times this resolution are scaled down to
+        it before any other processing. Defaults to None, which always uses the full image resolution.
     :return:
         Dict of image, image_width, image_height, margin_left, margin_top, page_width, page_height where all dimensions
         are specified in mm. This dict can be passed directly into process_single_image_pdf
     """
+    im = limit_resolution(im, squares_wide, squares_high, print_dpi)
     width_pixels, height_pixels = im.size
     logging.info('process_image_with_border: Image is {} x {} pixels'.format(width_pixels, height_pixels))
     pixels_per_mm = min(width_pixels / (squares_wide * 25.4), height_pixels / (squares_high * 25.4))
@@ -251,7 +428,169 @@ def process_image_with_border(im: Image, squares_wide: float, squares_high: floa
     }
 
 
-def make_single_page_pdf(image_spec: {}, pdf_filename: str):
+def _png_up_rows(pixels):
+    """
+    Lay out pixel data as PNG predictor rows using the Up filter, i.e. each row prefixed with filter type 2 and
+    stored as its difference from the row above. Map artwork changes little from one row to the next, so this
+    compresses much better than the raw pixels, and PDF readers undo it with /Predictor 15.
+
+    :param pixels:
+        HxW or HxWxC uint8 array
+    :return:
+        Filtered rows as bytes, ready to compress
+    """
+    flat = pixels.reshape(pixels.shape[0], -1)
+    rows = np.empty((flat.shape[0], flat.shape[1] + 1), dtype=np.uint8)
+    rows[:, 0] = 2
+    rows[0, 1:] = flat[0]
+    np.subtract(flat[1:], flat[:-1], out=rows[1:, 1:])
+    return rows.tobytes()
+
+
+def image_info(image: Image, compress_level=1, jpeg_quality=None):
+    """
+    Build the image description fpdf uses internally for a Flate encoded image, directly from a PIL image. This is
+    the same structure fpdf would produce from parsing a PNG file, but without the PNG encode and decode steps.
+
+    :param image:
+        An Image to encode, modes other than L, RGB and RGBA are converted to RGB (or RGBA if they have transparency)
+    :param compress_level:
+        zlib compression level, defaults to 1 as these streams are written once and favour speed over size. The PNG
+        Up predictor is applied first, so most of the size saving comes from that rather than the level.
+    :param jpeg_quality:
+        If set, encode opaque images as JPEG at this quality instead, which is much faster to encode and smaller for
+        photographic maps but lossy. Images with an alpha channel are always Flate encoded.
+    :return:
+        Dict of image properties and compressed data suitable for the FPDF images cache
+    """
+    image = _pixel_mode(image)
+    width, height = image.size
+    info = {'w': width, 'h': height, 'cs': 'DeviceGray' if image.mode == 'L' else 'DeviceRGB', 'bpc': 8,
+            'f': 'FlateDecode'}
+    if jpeg_quality is not None and image.mode != 'RGBA':
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=jpeg_quality)
+        info['f'] = 'DCTDecode'
+        info['data'] = buffer.getvalue()
+        return info
+    if image.mode == 'RGBA':
+        # fpdf always writes soft masks with the PNG predictor parameters below, with one colour
+        info['smask'] = zlib.compress(_png_up_rows(np.asarray(image.getchannel('A'))), compress_level)
+        image = image.convert('RGB')
+    info['dp'] = f'/Predictor 15 /Colors {len(image.getbands())} /BitsPerComponent 8 /Columns {width}'
+    info['data'] = zlib.compress(_png_up_rows(np.asarray(image)), compress_level)
+    return info
+
+
+class _PDFBuffer:
+    """
+    Stands in for the string fpdf accumulates the finished document in. fpdf appends to that string once per line of
+    output, copying everything written so far each time, which is slow once large images have been written. This
+    keeps the pieces in a list and only joins them when the content is needed.
+    """
+
+    def __init__(self, s=''):
+        self.parts = [s]
+        self.length = len(s)
+
+    def __iadd__(self, s):
+        self.parts.append(s)
+        self.length += len(s)
+        return self
+
+    def __len__(self):
+        return self.length
+
+    def __str__(self):
+        return ''.join(self.parts)
+
+    def encode(self, encoding):
+        return str(self).encode(encoding)
+
+
+class InMemoryImagePDF(FPDF):
+    """
+    Extension of FPDF class to place PIL images directly. fpdf 1.7 will only read images from a file, so without this
+    each image has to be saved as a PNG and then read back in and parsed again. Also batches line drawing and output
+    so documents containing large images can be written efficiently.
+    """
+
+    @property
+    def buffer(self):
+        return self._buffer
+
+    @buffer.setter
+    def buffer(self, value):
+        # fpdf only ever assigns an initial string, or the result of += on this buffer
+        self._buffer = value if isinstance(value, _PDFBuffer) else _PDFBuffer(value)
+
+    def output(self, name='', dest=''):
+        result = super().output(name, dest)
+        # Return a real string rather than the buffer object when asked for the document as a string
+        return str(result) if isinstance(result, _PDFBuffer) else result
+
+    def pil_image(self, image: Image, name: str, x, y, w, h, compress_level=1, jpeg_quality=None):
+        """
+        Put a PIL image on the page
+
+        :param image:
+            The Image to place
+        :param name:
+            Name used to key the image in fpdf's image cache, must be unique for each distinct image
+        :param x:
+            Left position in user units
+        :param y:
+            Top position in user units
+        :param w:
+            Width in user units
+        :param h:
+            Height in user units
+        :param compress_level:
+            zlib compression level for the image data
+        :param jpeg_quality:
+            If set, encode as JPEG at this quality rather than lossless, see image_info
+        """
+        if name not in self.images:
+            self.register_image(name, image_info(image, compress_level, jpeg_quality))
+        self.image(name, x, y, w, h)
+
+    def lines(self, segments, dash=False):
+        """
+        Draw a set of lines, equivalent to calling line() or dashed_line() for each but written to the page as a
+        single block
+
+        :param segments:
+            Sequence of (x1, y1, x2, y2) tuples in user units
+        :param dash:
+            Set to True to draw dashed lines, with the same default dash pattern as dashed_line()
+        """
+        if not segments:
+            return
+        k = self.k
+        h = self.h
+        ops = [f'{x1 * k:.2f} {(h - y1) * k:.2f} m {x2 * k:.2f} {(h - y2) * k:.2f} l S' for x1, y1, x2, y2 in segments]
+        if dash:
+            ops.insert(0, f'[{k:.3f} {k:.3f}] 0 d')
+            ops.append('[] 0 d')
+        self._out('\n'.join(ops))
+
+    def register_image(self, name: str, info: {}):
+        """
+        Add an already encoded image to the image cache, after which it can be placed by name with image()
+
+        :param name:
+            Name used to key the image in fpdf's image cache
+        :param info:
+            Return from image_info
+        """
+        if 'smask' in info and self.pdf_version < '1.4':
+            # Soft masks need PDF 1.4
+            self.pdf_version = '1.4'
+        info['i'] = len(self.images) + 1
+        self.images[name] = info
+
+
+def make_single_page_pdf(image_spec: {}, pdf_filename: str, jpeg_quality=None):
     """
     Take the processed image from process_image_with_border and produce a PDF file with those exact dimensions and a
     single page.
@@ -260,22 +599,23 @@ def make_single_page_pdf(image_spec: {}, pdf_filename: str):
         Return from process_image_with_border
     :param filename:
         Filename to write
+    :param jpeg_quality:
+        If set, embed the image as a JPEG of this quality, i.e. 95, rather than losslessly
     """
-    pdf = FPDF(unit='mm', format=(image_spec['page_width'], image_spec['page_height']))
-    with tempfile.TemporaryDirectory() as dirpath:
-        pdf.add_page()
-        image_spec['image'].save(f'{dirpath}/image.png')
-        pdf.image(f'{dirpath}/image.png',
+    pdf = InMemoryImagePDF(unit='mm', format=(image_spec['page_width'], image_spec['page_height']))
+    pdf.add_page()
+    pdf.pil_image(image_spec['image'], 'image',
                   image_spec['margin_left'],
                   image_spec['margin_top'],
                   image_spec['image_width'],
-                  image_spec['image_height'])
-        pdf.output(pdf_filename, 'F')
+                  image_spec['image_height'],
+                  jpeg_quality=jpeg_quality)
+    pdf.output(pdf_filename, 'F')
 
 
 def split_image(im: Image, squares_wide: float, squares_high: float, border_north=5, border_east=5, border_west=5,
                 border_south=5, overlap_east=10, overlap_south=10, paper=Paper.A4, brighten=None,
-                sharpen=None, saturation=None):
+                sharpen=None, saturation=None, print_dpi=None):
     """
     Split an input image into a set of images which will tile across the paper, either horizontally or vertically as
     determined by which would take the fewer pages when naively printed. At the moment this doesn't attempt to be
@@ -309,10 +649,15 @@ def split_image(im: Image, squares_wide: float, squares_high: float, border_nort
         Set to >1.0 to shapen the image before splitting.
     :param saturation:
         Set to >1.0 to enhance colour, <1.0 to remove it, None for no effect
+    :param print_dpi:
+        Resolution the output will be printed at. Images with more than 1.5 times this resolution are scaled down to
+        it before any other processing. Defaults to None, which always uses the full image resolution.
     :return:
-        A dict of {pixels_per_mm:int, images:{name : image}, orientation:str[L|P], border:int}
+        A dict of {pixels_per_mm:int, images:{name : array}, orientation:str[L|P], border:int}, where each array is a
+        view onto the pixel data of the enhanced image rather than a copy
     """
 
+    im = limit_resolution(im, squares_wide, squares_high, print_dpi)
     width_pixels, height_pixels = im.size
     logging.info('split_image: Image is {} x {} pixels'.format(width_pixels, height_pixels))
     pixels_per_mm = min(width_pixels / (squares_wide * 25.4), height_pixels / (squares_high * 25.4))
@@ -323,11 +668,12 @@ def split_image(im: Image, squares_wide: float, squares_high: float, border_nort
 
     width_mm = width_pixels / pixels_per_mm
     height_mm = height_pixels / pixels_per_mm
+    paper_width, paper_height = paper.dimensions
 
     def get_page_size():
 
-        printable_width = paper.width - (border_east + border_west)
-        printable_height = paper.height - (border_north + border_south)
+        printable_width = paper_width - (border_east + border_west)
+        printable_height = paper_height - (border_north + border_south)
 
         def pages(size, printable_size, overlap):
             if math.ceil(size / printable_size) == 1:
@@ -376,14 +722,21 @@ def split_image(im: Image, squares_wide: float, squares_high: float, border_nort
         overlap_south_pixels = pixels_per_mm * overlap_east
         borders = [border_east, border_south + overlap_east, border_west + overlap_south, border_north]
 
-    def crop_for(page_x, page_y):
-        return im.crop((page_x * pixel_width_page, page_y * pixel_height_page,
-                        min(width_pixels, (page_x + 1) * pixel_width_page + overlap_east_pixels),
-                        min(height_pixels, (page_y + 1) * pixel_height_page + overlap_south_pixels)))
+    # Take tiles as views onto a single array, they're only copied when they're finally encoded into the PDF. Bounds
+    # are rounded the same way Image.crop rounds them
+    arr = np.asarray(_pixel_mode(im))
+    x0 = np.rint(np.arange(pages_horizontal) * pixel_width_page).astype(int)
+    y0 = np.rint(np.arange(pages_vertical) * pixel_height_page).astype(int)
+    x1 = np.minimum(width_pixels,
+                    np.rint(np.arange(1, pages_horizontal + 1) * pixel_width_page + overlap_east_pixels).astype(int))
+    y1 = np.minimum(height_pixels,
+                    np.rint(np.arange(1, pages_vertical + 1) * pixel_height_page + overlap_south_pixels).astype(int))
+    # Build the slices once per column and row, each tile is then just a lookup of one of each
+    columns = [slice(start, end) for start, end in zip(x0.tolist(), x1.tolist())]
+    rows = [slice(start, end) for start, end in zip(y0.tolist(), y1.tolist())]
 
     return {'pixels_per_mm': pixels_per_mm,
-            'images': {'{}_{}'.format(x, y): crop_for(x, y) for x in range(pages_horizontal) for y in
-                       range(pages_vertical)},
+            'images': {f'{x}_{y}': arr[row, column] for x, column in enumerate(columns) for y, row in enumerate(rows)},
             'orientation': orientation,
             'border': borders,
             'pages_horizontal': pages_horizontal,
@@ -391,7 +744,7 @@ def split_image(im: Image, squares_wide: float, squares_high: float, border_nort
             'paper': paper}
 
 
-def make_pdf(images, pdf_filename):
+def make_pdf(images, pdf_filename, jpeg_quality=None):
     """
     Write a set of images from split_images into a combined A4 PDF file
 
@@ -399,20 +752,29 @@ def make_pdf(images, pdf_filename):
         The output dict from split_images
     :param pdf_filename:
         Full name of the PDF to write
+    :param jpeg_quality:
+        If set, embed the tiles as JPEGs of this quality, i.e. 95, rather than losslessly
     """
     logging.info('make_pdf: Building PDF file {} from image data'.format(pdf_filename))
-    pdf = FPDF(orientation=images['orientation'], unit='mm', format=images['paper'].dimensions)
+    paper_dimensions = images['paper'].dimensions
+    pdf = InMemoryImagePDF(orientation=images['orientation'], unit='mm', format=paper_dimensions)
     ppm = images['pixels_per_mm']
     border_north, border_east, border_south, border_west = images['border']
     if images['orientation'] == 'P':
-        page_width, page_height = images['paper'].dimensions
+        page_width, page_height = paper_dimensions
     else:
-        page_height, page_width = images['paper'].dimensions
+        page_height, page_width = paper_dimensions
+
+    # Crop marks for the current page, written in one go once the page is complete
+    solid_marks = []
+    dashed_marks = []
 
     def tick(x, y, size=5, gap=1, n=False, e=False, s=False, w=False, dash=False):
-        line = pdf.line
-        if dash:
-            line = pdf.dashed_line
+        marks = dashed_marks if dash else solid_marks
+
+        def line(x1, y1, x2, y2):
+            marks.append((x1, y1, x2, y2))
+
         if w:
             if x <= size:
                 line(x - gap, y, 0, y)
@@ -434,45 +796,60 @@ def make_pdf(images, pdf_filename):
             else:
                 line(x, y + gap, x, y + size)
 
-    with tempfile.TemporaryDirectory() as dirpath:
-        for coords, image in images['images'].items():
-            pdf.add_page()
+    def encode(tile):
+        # Name each image by its content, so identical tiles are only embedded in the PDF once
+        info = image_info(Image.fromarray(tile), jpeg_quality=jpeg_quality)
+        digest = hashlib.blake2b(info['data'], digest_size=8)
+        if 'smask' in info:
+            digest.update(info['smask'])
+        return f'{info["w"]}x{info["h"]}_{digest.hexdigest()}', info
+
+    # Compress all the tiles up front, zlib releases the GIL so this runs across all available cores
+    image_names = {}
+    with ThreadPoolExecutor() as executor:
+        for coords, (name, info) in zip(images['images'], executor.map(encode, images['images'].values())):
+            image_names[coords] = name
+            if name not in pdf.images:
+                pdf.register_image(name, info)
+
+    for coords, tile in images['images'].items():
+        pdf.add_page()
 
-            m = re.match(r'(\d+)_(\d+)', coords)
-            x = int(m.groups()[0])
-            y = int(m.groups()[1])
+        x, y = map(int, coords.split('_', 1))
 
-            im_width, im_height = image.size
+        im_height, im_width = tile.shape[:2]
 
-            im_width_mm = im_width / ppm
-            im_height_mm = im_height / ppm
-            last_vertical = y == images['pages_vertical'] - 1
-            last_horizontal = x == images['pages_horizontal'] - 1
+        im_width_mm = im_width / ppm
+        im_height_mm = im_height / ppm
+        last_vertical = y == images['pages_vertical'] - 1
+        last_horizontal = x == images['pages_horizontal'] - 1
 
-            # Always position the top left one the same
-            tick(border_west, border_north, n=True, w=True)
-            tick(border_west, border_north + im_height_mm, s=True, w=True)
-            tick(border_west + im_width_mm, border_north + im_height_mm, e=True, s=True)
-            tick(border_west + im_width_mm, border_north, e=True, n=True)
+        # Always position the top left one the same
+        tick(border_west, border_north, n=True, w=True)
+        tick(border_west, border_north + im_height_mm, s=True, w=True)
+        tick(border_west + im_width_mm, border_north + im_height_mm, e=True, s=True)
+        tick(border_west + im_width_mm, border_north, e=True, n=True)
 
-            if not last_horizontal:
-                tick(page_width - border_east, im_height_mm + border_north, s=True, dash=True)
-                tick(page_width - border_east, border_north, n=True, dash=True)
+        if not last_horizontal:
+            tick(page_width - border_east, im_height_mm + border_north, s=True, dash=True)
+            tick(page_width - border_east, border_north, n=True, dash=True)
 
-            if not last_vertical:
-                tick(border_west, page_height - border_south, w=True, dash=True)
-                tick(border_west + im_width_mm, page_height - border_south, e=True, dash=True)
+        if not last_vertical:
+            tick(border_west, page_height - border_south, w=True, dash=True)
+            tick(border_west + im_width_mm, page_height - border_south, e=True, dash=True)
 
-            # tick(page_width - border_east, border_north, n=True, e=True)
-            # tick(page_width - border_east, page_height - border_south, e=True, s=True)
-            image.save('{}/{}.png'.format(dirpath, coords))
-            pdf.image('{}/{}.png'.format(dirpath, coords), border_west, border_north, im_width / ppm,
-                      im_height / ppm)
+        # tick(page_width - border_east, border_north, n=True, e=True)
+        # tick(page_width - border_east, page_height - border_south, e=True, s=True)
+        pdf.lines(solid_marks)
+        pdf.lines(dashed_marks, dash=True)
+        solid_marks.clear()
+        dashed_marks.clear()
+        pdf.image(image_names[coords], border_west, border_north, im_width_mm, im_height_mm)
     pdf.output(pdf_filename, 'F')
     logging.info('make_pdf: Wrote {} images to PDF file {}'.format(len(images['images']), pdf_filename))
 
 
-def extract_images_from_pdf(pdf_filename: str, page=None, to_page=None, min_width=100, min_height=100):
+def extract_images_from_pdf(pdf_filename: str, page=None, to_page=None, min_width=100, min_height=100, reader=None):
     """
     Pull images out of a PDF file by page range, including finding any SMask elements and applying them
     as alpha channels. Technique taken from this stackoverflow post :
@@ -489,6 +866,10 @@ def extract_images_from_pdf(pdf_filename: str, page=None, to_page=None, min_widt
         Minimum width in pixels, below this images are rejected
     :param min_height:
         Minimum height in pixels, below this images are rejected
+    :param reader:
+        Optional PdfReader already open on this file. pypdf keeps decoded image streams once they've been read, so
+        passing the same reader to repeated calls on one file, i.e. with a different size filter or page range,
+        avoids decoding them again. If None, the file is opened and read for this call only.
     :return:
         A generator of images from this PDF
     """
@@ -553,23 +934,29 @@ def extract_images_from_pdf(pdf_filename: str, page=None, to_page=None, min_widt
                         for sub_image in images_in_page(vobj):
                             if sub_image:
                                 yield sub_image
+                elif isinstance(v, IndirectObject) and v.idnum in seen_images:
+                    # Already found on an earlier page, don't decode it again
+                    pass
+                elif (int(vobj.get('/Width', min_width)) < min_width or
+                      int(vobj.get('/Height', min_height)) < min_height):
+                    # Too small, we can tell from the image dictionary without decoding it or its mask
+                    pass
                 elif img := image_from_vobj(vobj):
-                    if isinstance(v, IndirectObject) and v.idnum in seen_images:
-                        pass
-                    else:
-                        # Find an SMask if available and apply it
-                        if mask_img := (
-                                image_from_vobj(vobj['/SMask'], image_format='L') if '/SMask' in vobj else None):
-                            img.putalpha(mask_img)
-                        if isinstance(v, IndirectObject):
-                            seen_images.add(v.idnum)
-                        yield img
-
-    # Read in the PDF file
-    in_pdf = pdf.PdfReader(pdf_filename)
-    # Bug sometimes in PDFs with spaces in their filename (meh, whatever..)
-    if in_pdf.is_encrypted:
-        in_pdf.decrypt('')
+                    # Find an SMask if available and apply it
+                    if mask_img := (
+                            image_from_vobj(vobj['/SMask'], image_format='L') if '/SMask' in vobj else None):
+                        img.putalpha(mask_img)
+                    if isinstance(v, IndirectObject):
+                        seen_images.add(v.idnum)
+                    yield img
+
+    # Read in the PDF file, unless the caller already has it open
+    in_pdf = reader
+    if in_pdf is None:
+        in_pdf = pdf.PdfReader(pdf_filename)
+        # Bug sometimes in PDFs with spaces in their filename (meh, whatever..)
+        if in_pdf.is_encrypted:
+            in_pdf.decrypt('')
     # Iterate over target page range, and over images in each page
     for page_number in range(max(0, page or 0),
                              min(to_page or in_pdf.get_num_pages(), in_pdf.get_num_pages())):
@@ -41,6 +41,14 @@ parser.add_argument('-m', '--mode', type=str,
                          'of the requested size. Single mode produces a single PDF exactly fitting the map, and PNG mode produces a lower size PNG ' +
                          'image suitable for virtual tabletops such as Roll20',
                     default=conf.map_default_mode)
+parser.add_argument('-j', '--jpeg', type=int,
+                    help='tiled and single modes only - embed images in the PDF as JPEG with this quality, i.e. 95, ' +
+                         'rather than losslessly. Faster and smaller, but lossy. Default is lossless',
+                    default=None)
+parser.add_argument('-d', '--dpi', type=int,
+                    help='tiled and single modes only - scale maps with more than 1.5 times this resolution down to it, ' +
+                         'i.e. 300 for most printers. Default is to keep the resolution from the grid size',
+                    default=None)
 parser.add_argument('-x', '--preset', type=str,
                     help=f'preset, overrides settings from presets within the config file, available presets are [{"|".join(conf.map_presets.keys())}]',
                     default=None)
@@ -72,6 +80,12 @@ def main():
     mode = options.mode
     specified_paper_size = options.paper_size
     gridsize = options.gridsize
+    jpeg_quality = options.jpeg
+    print_dpi = options.dpi
+    # Distinguish lossy PDFs in their filenames, so they're not mistaken for lossless ones when checking for existing
+    jpeg_suffix = '' if jpeg_quality is None else f'j{jpeg_quality}'
+    # Likewise for PDFs scaled down to a print resolution
+    dpi_suffix = '' if print_dpi is None else f'd{print_dpi}'
 
     # Load from presets if specified
     if options.preset is not None:
@@ -121,7 +135,7 @@ def main():
                     logging.info(f'File {png_filename} already exists, skipping.')
 
             elif mode.upper() == 'SINGLE':
-                pdf_filename = f'{output_dir}/{name}_exact_p{page_border}c{saturation}s{sharpen}b{brighten}.pdf'
+                pdf_filename = f'{output_dir}/{name}_exact_p{page_border}c{saturation}s{sharpen}b{brighten}{dpi_suffix}{jpeg_suffix}.pdf'
                 if not isfile(pdf_filename):
                     image = Image.open(filename)
                     image = run_waifu2x(image)
@@ -132,13 +146,13 @@ def main():
                                                                     border_south=page_border,
                                                                     border_west=page_border,
                                                                     brighten=brighten, sharpen=sharpen,
-                                                                    saturation=saturation)
-                    mapmaker.make_single_page_pdf(image_spec, pdf_filename)
+                                                                    saturation=saturation, print_dpi=print_dpi)
+                    mapmaker.make_single_page_pdf(image_spec, pdf_filename, jpeg_quality=jpeg_quality)
                 else:
                     logging.info(f'File {pdf_filename} already exists, skipping.')
 
             elif mode.upper() == 'TILED':
-                pdf_filename = f'{output_dir}/{name}_{paper_size.name}_p{page_border}c{saturation}s{sharpen}b{brighten}o{overlap}.pdf'
+                pdf_filename = f'{output_dir}/{name}_{paper_size.name}_p{page_border}c{saturation}s{sharpen}b{brighten}o{overlap}{dpi_suffix}{jpeg_suffix}.pdf'
                 if not isfile(pdf_filename):
                     image = Image.open(filename)
                     image = run_waifu2x(image)
@@ -148,8 +162,8 @@ def main():
                                                  border_west=page_border,
                                                  brighten=brighten, sharpen=sharpen, saturation=saturation,
                                                  overlap_east=overlap,
-                                                 overlap_south=overlap, paper=paper_size)
-                    mapmaker.make_pdf(split, pdf_filename)
+                                                 overlap_south=overlap, paper=paper_size, print_dpi=print_dpi)
+                    mapmaker.make_pdf(split, pdf_filename, jpeg_quality=jpeg_quality)
                 else:
                     logging.info(f'File {pdf_filename} already exists, skipping.')
 
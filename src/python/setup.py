@@ -13,8 +13,9 @@ setup(
     license='GPL3',
     packages=find_namespace_packages(),
     install_requires=['requests==2.32.4', 'pydotplus==2.0.2', 'rply==0.7.8', 'pillow==11.3.0',
-                      'fpdf==1.7.2', 'pypdf==6.0.0', 'pyyaml==6.0.2', 'guizero==1.6.0', 'python-dateutil==2.9.0.post0',
+                      'fpdf==1.7.2', 'numpy==2.3.2', 'pypdf==6.0.0', 'pyyaml==6.0.2', 'guizero==1.6.0', 'python-dateutil==2.9.0.post0',
                       'beautifulsoup4==4.13.4', 'torch==2.8.0+cpu', 'torchvision==0.23.0+cpu'],
+    extras_require={'numba': ['numba==0.62.1']},
     package_data={'pathfinder.mapmaker.pytorch': ['*.pt'],
                   'pathfinder.utils': ['default_config.yaml']},
     test_suite='nose.collector',